@@ -3,6 +3,8 @@ import numpy as np
 import json
 import sys
 import os
+import hashlib
+import tempfile
 
 # Try to import dlib and imutils
 try:
@@ -13,7 +15,20 @@ except ImportError:
     DLIB_AVAILABLE = False
     print("Warning: dlib not available, using basic feature extraction", file=sys.stderr)
 
-def extract_features(image_path):
+# Cache of per-image detection results (rectangle, 68 landmarks, face crop)
+CACHE_DIR = "../data/face_cache"
+IMAGES_FILE = "../data/images.json"
+UPLOADS_DIR = "../uploads"
+# Bump CACHE_VERSION whenever the record layout changes
+CACHE_VERSION = 2
+# Longest side of the stored face crop, in pixels
+ROI_SIZE = 150
+RECORD_KEYS = (
+    "face_count", "rect", "landmarks", "face_roi", "image_shape", "image_avg_bgr",
+    "source_path", "source_size", "source_mtime_ns"
+)
+
+def extract_features(image_path, use_cache=True, cache_dir=CACHE_DIR):
     """
     Extracts detailed facial features from a portrait image.
     Features:
@@ -23,11 +38,20 @@ def extract_features(image_path):
     - Color histogram (average RGB values)
     - Face geometry features (distances, ratios)
     - Skin tone analysis
+
+    With dlib, detection results are stored in CACHE_DIR and reused on later
+    calls for the same unchanged image, so only the derived features are rebuilt.
     """
     try:
         # Check if file exists
         if not os.path.exists(image_path):
             return {"error": "File not found"}
+
+        # Reuse cached detection if the image has not changed since it was stored
+        if DLIB_AVAILABLE and use_cache:
+            record = load_cached_face(image_path, cache_dir)
+            if record is not None:
+                return derive_features(record)
             
         # Read image
         image = cv2.imread(image_path)
@@ -39,30 +63,97 @@ def extract_features(image_path):
         
         # Use dlib if available, otherwise fallback to basic method
         if DLIB_AVAILABLE:
-            return extract_features_dlib(image, gray)
+            return extract_features_dlib(image, gray, image_path if use_cache else None, cache_dir)
         else:
             return extract_features_basic(image, gray)
     except Exception as e:
         return {"error": f"Exception in feature extraction: {str(e)}"}
 
-def extract_features_dlib(image, gray):
+def extract_features_dlib(image, gray, image_path=None, cache_dir=CACHE_DIR):
     """Feature extraction using dlib for enhanced accuracy"""
     try:
-        # Initialize dlib's face detector and facial landmark predictor
-        detector_path = os.path.join(os.path.dirname(__file__), "shape_predictor_68_face_landmarks.dat")
-        
-        if not os.path.exists(detector_path):
-            return {"error": "dlib shape predictor model not found"}
-        
-        detector = dlib.get_frontal_face_detector()
-        predictor = dlib.shape_predictor(detector_path)
-        
-        # Detect faces
-        rects = detector(gray, 1)
+        record = detect_face_dlib(image, gray)
+        if "error" in record:
+            return record
+
+        if image_path is not None:
+            try:
+                save_face_cache(image_path, record, cache_dir)
+            except Exception as e:
+                print(f"Warning: could not write face cache: {str(e)}", file=sys.stderr)
+
+        return derive_features(record)
+    except Exception as e:
+        return {"error": f"Exception in dlib feature extraction: {str(e)}"}
+
+def detect_face_dlib(image, gray):
+    """
+    Run dlib detection and landmarking, returning the raw record that
+    derive_features() needs for the first face: detection rectangle,
+    68-point landmarks and the bounding-box crop used for color features.
+    """
+    # Initialize dlib's face detector and facial landmark predictor
+    detector_path = os.path.join(os.path.dirname(__file__), "shape_predictor_68_face_landmarks.dat")
+    
+    if not os.path.exists(detector_path):
+        return {"error": "dlib shape predictor model not found"}
+    
+    detector = dlib.get_frontal_face_detector()
+    predictor = dlib.shape_predictor(detector_path)
+    
+    # Detect faces
+    rects = detector(gray, 1)
+    
+    # Whole-image average color is kept for images without a face
+    record = {
+        "face_count": np.int32(len(rects)),
+        "image_shape": np.array(image.shape, dtype=np.int32),
+        "image_avg_bgr": np.average(np.average(image, axis=0), axis=0),
+        "rect": np.zeros(0, dtype=np.int32),
+        "landmarks": np.zeros((0, 2), dtype=np.int32),
+        "face_roi": np.zeros((0, 0, 3), dtype=np.uint8)
+    }
+    
+    if len(rects) > 0:
+        # For simplicity, take the first detected face
+        rect = rects[0]
+        (x, y, w, h) = (rect.left(), rect.top(), rect.width(), rect.height())
+        record["rect"] = np.array([x, y, w, h], dtype=np.int32)
+        
+        # Extract facial landmarks
+        detection = predictor(gray, rect)
+        record["landmarks"] = face_utils.shape_to_np(detection).astype(np.int32)
+        
+        # Region of interest (face) as cropped from the detection box
+        face_roi = image[max(0, y):min(image.shape[0], y+h), max(0, x):min(image.shape[1], x+w)]
+        record["face_roi"] = shrink_face_roi(face_roi)
+
+    return record
+
+def shrink_face_roi(face_roi):
+    """
+    Downscale a face crop so its longest side is at most ROI_SIZE, keeping
+    the cache compact. Area interpolation averages source pixels, so the
+    average color stays within about one level of the full-size crop.
+    """
+    longest = max(face_roi.shape[:2])
+    if longest <= ROI_SIZE:
+        return face_roi
+    scale = ROI_SIZE / longest
+    size = (max(1, round(face_roi.shape[1] * scale)), max(1, round(face_roi.shape[0] * scale)))
+    return cv2.resize(face_roi, size, interpolation=cv2.INTER_AREA)
+
+def derive_features(record):
+    """
+    Build the feature dict from a face record produced by detect_face_dlib()
+    or loaded from the cache. Needs neither the original image nor dlib.
+    """
+    try:
+        face_count = int(record["face_count"])
         
         features = {
-            "has_face": len(rects) > 0,
-            "face_count": len(rects),
+            "has_face": face_count > 0,
+            "face_count": face_count,
             "face_bbox": None,
             "landmarks": None,
             "face_geometry": None,
@@ -73,35 +164,23 @@ def extract_features_dlib(image, gray):
             "nose_features": None
         }
         
-        if len(rects) > 0:
-            # For simplicity, take the first detected face
-            rect = rects[0]
+        if face_count > 0:
+            (x, y, w, h) = (int(v) for v in record["rect"])
+            shape = record["landmarks"]
+            face_roi = record["face_roi"]
             
             # Face bounding box
-            features["face_bbox"] = {
-                "x": int(rect.left()),
-                "y": int(rect.top()),
-                "width": int(rect.width()),
-                "height": int(rect.height())
-            }
-            
-            # Extract facial landmarks
-            shape = predictor(gray, rect)
-            shape = face_utils.shape_to_np(shape)
+            features["face_bbox"] = {"x": x, "y": y, "width": w, "height": h}
             
             # Convert landmarks to dictionary
             landmarks_dict = {}
-            for i, (x, y) in enumerate(shape):
-                landmarks_dict[f"point_{i}"] = {"x": int(x), "y": int(y)}
+            for i, (px, py) in enumerate(shape):
+                landmarks_dict[f"point_{i}"] = {"x": int(px), "y": int(py)}
             
             features["landmarks"] = landmarks_dict
             
-            # Extract region of interest (face)
-            (x, y, w, h) = (rect.left(), rect.top(), rect.width(), rect.height())
-            face_roi = image[max(0, y):min(image.shape[0], y+h), max(0, x):min(image.shape[1], x+w)]
-            
             # --- Detailed Face Geometry Features ---
-            features["face_geometry"] = extract_face_geometry(shape, image.shape)
+            features["face_geometry"] = extract_face_geometry(shape, tuple(record["image_shape"]))
             
             # --- Average Color ---
             avg_color_per_row = np.average(face_roi, axis=0)
@@ -125,8 +204,7 @@ def extract_features_dlib(image, gray):
             features["nose_features"] = extract_nose_features(shape)
         else:
             # If no face, use whole image for color
-            avg_color_per_row = np.average(image, axis=0)
-            avg_color = np.average(avg_color_per_row, axis=0)
+            avg_color = record["image_avg_bgr"]
             features["avg_color"] = {
                 "r": int(avg_color[2]),  # OpenCV uses BGR
                 "g": int(avg_color[1]),
@@ -135,7 +213,197 @@ def extract_features_dlib(image, gray):
             
         return features
     except Exception as e:
-        return {"error": f"Exception in dlib feature extraction: {str(e)}"}
+        return {"error": f"Exception in feature derivation: {str(e)}"}
+
+def get_cache_path(image_path, cache_dir=CACHE_DIR):
+    """Cache file for an image: its file name plus a hash of its absolute path"""
+    source_path = os.path.abspath(image_path)
+    digest = hashlib.sha1(source_path.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{os.path.basename(source_path)}-{digest}.npz")
+
+def save_face_cache(image_path, record, cache_dir=CACHE_DIR):
+    """Store a face record along with its format and the source file's size and mtime"""
+    os.makedirs(cache_dir, exist_ok=True)
+    source_path = os.path.abspath(image_path)
+    stat = os.stat(source_path)
+    cache_path = get_cache_path(source_path, cache_dir)
+    
+    # Write to a private temporary file first so readers never see a partial entry
+    tmp = tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False)
+    try:
+        with tmp:
+            np.savez_compressed(
+                tmp,
+                cache_version=np.int32(CACHE_VERSION),
+                roi_size=np.int32(ROI_SIZE),
+                source_path=np.array(source_path),
+                source_size=np.int64(stat.st_size),
+                source_mtime_ns=np.int64(stat.st_mtime_ns),
+                **record
+            )
+        os.replace(tmp.name, cache_path)
+    except Exception:
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+        raise
+    return cache_path
+
+def load_face_cache(cache_path):
+    """Load a stored face record"""
+    with np.load(cache_path, allow_pickle=False) as data:
+        return {key: data[key] for key in data.files}
+
+def is_current_record(record):
+    """True if a stored record matches the current cache format and crop size"""
+    try:
+        return (int(record["cache_version"]) == CACHE_VERSION and
+                int(record["roi_size"]) == ROI_SIZE and
+                all(key in record for key in RECORD_KEYS))
+    except KeyError:
+        return False
+
+def is_fresh_record(record, image_path):
+    """True if the image file still has the size and mtime recorded in the cache"""
+    if not os.path.exists(image_path):
+        return False
+    stat = os.stat(image_path)
+    return (int(record["source_size"]) == stat.st_size and
+            int(record["source_mtime_ns"]) == stat.st_mtime_ns)
+
+def load_cached_face(image_path, cache_dir=CACHE_DIR):
+    """Return the cached record for an image, or None if missing, outdated or stale"""
+    cache_path = get_cache_path(image_path, cache_dir)
+    if not os.path.exists(cache_path):
+        return None
+    
+    try:
+        record = load_face_cache(cache_path)
+        if not is_current_record(record) or not is_fresh_record(record, image_path):
+            return None
+        return record
+    except Exception as e:
+        print(f"Warning: ignoring unreadable face cache {cache_path}: {str(e)}", file=sys.stderr)
+        return None
+
+def recompute_features(cache_dir=CACHE_DIR):
+    """
+    Rebuild derived features for every cached image without decoding the
+    originals or running the detector. Returns {source image path: features};
+    entries that are outdated, or whose image was changed or deleted, get an
+    error instead and should be re-extracted.
+    """
+    if not os.path.isdir(cache_dir):
+        return {}
+    
+    results = {}
+    for name in sorted(os.listdir(cache_dir)):
+        if not name.endswith(".npz"):
+            continue
+        cache_path = os.path.join(cache_dir, name)
+        try:
+            record = load_face_cache(cache_path)
+        except Exception as e:
+            results[cache_path] = {"error": f"Could not read face cache: {str(e)}"}
+            continue
+        
+        source_path = str(record["source_path"]) if "source_path" in record else cache_path
+        try:
+            if not is_current_record(record):
+                results[source_path] = {"error": "Face cache entry has an outdated format"}
+            elif not os.path.exists(source_path):
+                results[source_path] = {"error": "Source image no longer exists"}
+            elif not is_fresh_record(record, source_path):
+                results[source_path] = {"error": "Source image changed since it was cached"}
+            else:
+                results[source_path] = derive_features(record)
+        except Exception as e:
+            results[source_path] = {"error": f"Invalid face cache entry: {str(e)}"}
+    return results
+
+def apply_recomputed_features(results, images_file=IMAGES_FILE):
+    """
+    Replace the stored features in images.json with recomputed ones, matched
+    by file name. Images with an error result, with a file name cached from
+    more than one location, or with no cache entry at all are left untouched.
+    Returns a summary of what was updated.
+    """
+    # Count every cached location, including failed ones, before picking results
+    by_filename = {}
+    ambiguous = set()
+    for source_path, features in results.items():
+        filename = os.path.basename(source_path)
+        if filename in by_filename:
+            ambiguous.add(filename)
+        by_filename[filename] = features
+    for filename in ambiguous:
+        del by_filename[filename]
+    
+    with open(images_file, "r", encoding="utf-8") as f:
+        images = json.load(f)
+    
+    updated = []
+    uncached = []
+    for image in images:
+        filename = image.get("filename")
+        features = by_filename.get(filename)
+        if features is None:
+            if filename not in ambiguous:
+                uncached.append(filename)
+        elif "error" not in features:
+            image["features"] = features
+            updated.append(filename)
+    
+    if updated:
+        # Same layout the backend writes (JSON.stringify with 2-space indent)
+        tmp_path = f"{images_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(images, f, indent=2)
+            os.replace(tmp_path, images_file)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    
+    return {
+        "updated": updated,
+        "ambiguous": sorted(ambiguous),
+        "uncached": uncached,
+        "errors": {path: features["error"] for path, features in results.items() if "error" in features}
+    }
+
+def build_face_cache(images_file=IMAGES_FILE, uploads_dir=UPLOADS_DIR, cache_dir=CACHE_DIR):
+    """
+    Run detection once for every image in images.json that has no current
+    cache entry, so later recomputes cover the whole corpus. Stored features
+    are not modified. Returns a summary of what was cached.
+    """
+    if not DLIB_AVAILABLE:
+        return {"error": "dlib not available, face cache cannot be built"}
+    
+    with open(images_file, "r", encoding="utf-8") as f:
+        images = json.load(f)
+    
+    cached = []
+    already_cached = 0
+    errors = {}
+    for image in images:
+        filename = image.get("filename")
+        if not filename:
+            continue
+        image_path = os.path.join(uploads_dir, filename)
+        if load_cached_face(image_path, cache_dir) is not None:
+            already_cached += 1
+            continue
+        features = extract_features(image_path, cache_dir=cache_dir)
+        if "error" in features:
+            errors[filename] = features["error"]
+        elif load_cached_face(image_path, cache_dir) is None:
+            errors[filename] = "Face cache entry was not written"
+        else:
+            cached.append(filename)
+    
+    return {"cached": cached, "already_cached": already_cached, "errors": errors}
 
 def extract_features_basic(image, gray):
     """Fallback feature extraction using Haar cascades"""
@@ -445,6 +713,24 @@ def extract_nose_features(shape):
 
 if __name__ == "__main__":
     try:
+        if len(sys.argv) >= 2 and sys.argv[1] == "--build-cache":
+            if len(sys.argv) != 2:
+                print(json.dumps({"error": "Usage: python feature_extractor.py --build-cache"}))
+                sys.exit(1)
+            print(json.dumps(build_face_cache()))
+            sys.exit(0)
+        
+        if len(sys.argv) >= 2 and sys.argv[1] == "--recompute":
+            if sys.argv[2:] not in ([], ["--apply"]):
+                print(json.dumps({"error": "Usage: python feature_extractor.py --recompute [--apply]"}))
+                sys.exit(1)
+            results = recompute_features()
+            if sys.argv[2:] == ["--apply"]:
+                print(json.dumps(apply_recomputed_features(results)))
+            else:
+                print(json.dumps(results))
+            sys.exit(0)
+        
         if len(sys.argv) != 2:
             print(json.dumps({"error": "Usage: python feature_extractor.py <image_path>"}))
             sys.exit(1)
@@ -0,0 +1,182 @@
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+
+import feature_extractor as fe
+
+
+def make_record(face=True):
+    """Synthetic record shaped like detect_face_dlib() output"""
+    rng = np.random.RandomState(0)
+    record = {
+        "face_count": np.int32(1 if face else 0),
+        "image_shape": np.array([120, 100, 3], dtype=np.int32),
+        "image_avg_bgr": np.array([10.0, 20.0, 30.0]),
+        "rect": np.zeros(0, dtype=np.int32),
+        "landmarks": np.zeros((0, 2), dtype=np.int32),
+        "face_roi": np.zeros((0, 0, 3), dtype=np.uint8)
+    }
+    if face:
+        record["rect"] = np.array([20, 30, 50, 60], dtype=np.int32)
+        record["landmarks"] = rng.randint(20, 80, (68, 2)).astype(np.int32)
+        record["face_roi"] = rng.randint(0, 256, (60, 50, 3)).astype(np.uint8)
+    return record
+
+
+def derive(record):
+    """derive_features() with a fixed seed for the k-means in analyze_skin_tone()"""
+    cv2.setRNGSeed(0)
+    return fe.derive_features(record)
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / "uploads" / "image-1.jpg"
+    path.parent.mkdir()
+    path.write_bytes(b"not really a jpeg")
+    return str(path)
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return str(tmp_path / "face_cache")
+
+
+def test_cache_round_trip_matches_fresh_features(image_path, cache_dir):
+    record = make_record()
+    fe.save_face_cache(image_path, record, cache_dir)
+
+    cached = fe.load_cached_face(image_path, cache_dir)
+    assert cached is not None
+    assert derive(cached) == derive(record)
+    assert [name for name in os.listdir(cache_dir) if name.endswith(".tmp")] == []
+
+
+def test_no_face_record_uses_image_color(image_path, cache_dir):
+    fe.save_face_cache(image_path, make_record(face=False), cache_dir)
+    features = derive(fe.load_cached_face(image_path, cache_dir))
+    assert features["has_face"] is False
+    assert features["avg_color"] == {"r": 30, "g": 20, "b": 10}
+
+
+def test_changed_image_is_a_cache_miss(image_path, cache_dir):
+    fe.save_face_cache(image_path, make_record(), cache_dir)
+    stat = os.stat(image_path)
+    os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert fe.load_cached_face(image_path, cache_dir) is None
+
+
+def test_outdated_or_incomplete_entry_is_a_cache_miss(image_path, cache_dir, monkeypatch):
+    record = make_record()
+    del record["landmarks"]
+    fe.save_face_cache(image_path, record, cache_dir)
+    assert fe.load_cached_face(image_path, cache_dir) is None
+
+    fe.save_face_cache(image_path, make_record(), cache_dir)
+    monkeypatch.setattr(fe, "CACHE_VERSION", fe.CACHE_VERSION + 1)
+    assert fe.load_cached_face(image_path, cache_dir) is None
+
+
+def test_corrupt_entry_is_a_cache_miss(image_path, cache_dir):
+    os.makedirs(cache_dir)
+    with open(fe.get_cache_path(image_path, cache_dir), "wb") as f:
+        f.write(b"garbage")
+    assert fe.load_cached_face(image_path, cache_dir) is None
+
+
+def test_same_file_name_in_different_directories(tmp_path, image_path, cache_dir):
+    other = tmp_path / "other" / os.path.basename(image_path)
+    other.parent.mkdir()
+    other.write_bytes(b"another image")
+    assert fe.get_cache_path(image_path, cache_dir) != fe.get_cache_path(str(other), cache_dir)
+
+
+def test_recompute_flags_deleted_images_and_applies_results(tmp_path, image_path, cache_dir):
+    record = make_record()
+    fe.save_face_cache(image_path, record, cache_dir)
+    gone = tmp_path / "uploads" / "image-2.jpg"
+    gone.write_bytes(b"deleted later")
+    fe.save_face_cache(str(gone), make_record(face=False), cache_dir)
+    gone.unlink()
+
+    cv2.setRNGSeed(0)
+    results = fe.recompute_features(cache_dir)
+    assert results[os.path.abspath(image_path)] == derive(record)
+    assert "error" in results[os.path.abspath(str(gone))]
+
+    images_file = tmp_path / "images.json"
+    old_features = {"has_face": False, "avg_color": {"r": 0, "g": 0, "b": 0}}
+    images_file.write_text(json.dumps([
+        {"filename": "image-1.jpg", "features": {}},
+        {"filename": "image-2.jpg", "features": old_features}
+    ]))
+
+    summary = fe.apply_recomputed_features(results, str(images_file))
+    assert summary["updated"] == ["image-1.jpg"]
+    images = json.loads(images_file.read_text())
+    assert images[0]["features"] == derive(record)
+    assert images[1]["features"] == old_features
+
+
+def test_entry_without_source_metadata_is_reported(image_path, cache_dir):
+    fe.save_face_cache(image_path, make_record(), cache_dir)
+    cache_path = fe.get_cache_path(image_path, cache_dir)
+    record = fe.load_face_cache(cache_path)
+    del record["source_size"]
+    with open(cache_path, "wb") as f:
+        np.savez_compressed(f, **record)
+
+    assert fe.load_cached_face(image_path, cache_dir) is None
+    results = fe.recompute_features(cache_dir)
+    assert "error" in results[os.path.abspath(image_path)]
+
+
+def test_duplicate_file_name_is_not_applied(tmp_path, image_path, cache_dir):
+    fe.save_face_cache(image_path, make_record(), cache_dir)
+    other = tmp_path / "other" / os.path.basename(image_path)
+    other.parent.mkdir()
+    other.write_bytes(b"another image")
+    fe.save_face_cache(str(other), make_record(), cache_dir)
+    other.unlink()
+
+    images_file = tmp_path / "images.json"
+    images_file.write_text(json.dumps([{"filename": "image-1.jpg", "features": {}}]))
+    summary = fe.apply_recomputed_features(fe.recompute_features(cache_dir), str(images_file))
+    assert summary["updated"] == []
+    assert summary["ambiguous"] == ["image-1.jpg"]
+    assert json.loads(images_file.read_text())[0]["features"] == {}
+
+
+def test_shrink_face_roi_keeps_average_color():
+    rng = np.random.RandomState(1)
+    face_roi = rng.randint(0, 256, (700, 600, 3)).astype(np.uint8)
+    small = fe.shrink_face_roi(face_roi)
+    assert max(small.shape[:2]) == fe.ROI_SIZE
+    assert np.allclose(small.mean(axis=(0, 1)), face_roi.mean(axis=(0, 1)), atol=1)
+
+
+def test_build_cache_backfills_uncached_images(tmp_path, cache_dir, monkeypatch):
+    uploads = tmp_path / "uploads"
+    uploads.mkdir()
+    for name in ("image-1.jpg", "image-2.jpg"):
+        cv2.imwrite(str(uploads / name), np.zeros((20, 20, 3), dtype=np.uint8))
+    images_file = tmp_path / "images.json"
+    images_file.write_text(json.dumps([
+        {"filename": "image-1.jpg", "features": {}},
+        {"filename": "image-2.jpg", "features": {}},
+        {"filename": "missing.jpg", "features": {}}
+    ]))
+    fe.save_face_cache(str(uploads / "image-1.jpg"), make_record(), cache_dir)
+
+    monkeypatch.setattr(fe, "DLIB_AVAILABLE", True)
+    monkeypatch.setattr(fe, "detect_face_dlib", lambda image, gray: make_record(face=False))
+    summary = fe.build_face_cache(str(images_file), str(uploads), cache_dir)
+
+    assert summary["cached"] == ["image-2.jpg"]
+    assert summary["already_cached"] == 1
+    assert list(summary["errors"]) == ["missing.jpg"]
+    assert fe.load_cached_face(str(uploads / "image-2.jpg"), cache_dir) is not None